@@ -51,21 +51,21 @@ def format_line(color, pid, syslog_entry, include_label):
     if (pid != -1) and (syslog_pid != pid):
         return None
 
-    if syslog_entry.label is not None:
-        label = f'[{syslog_entry.label.subsystem}][{syslog_entry.label.category}]'
+    if syslog_entry.subsystem is not None:
+        label = f'[{syslog_entry.subsystem}][{syslog_entry.category}]'
 
     if color:
         timestamp = colored(str(timestamp), 'green')
         process_name = colored(process_name, 'magenta')
         if len(image_name) > 0:
             image_name = colored(image_name, 'magenta')
-        syslog_pid = colored(syslog_entry['pid'], 'cyan')
+        syslog_pid = colored(syslog_pid, 'cyan')
 
-        if level in syslog_entry:
+        if level in log_level_colors:
             level = colored(level, log_level_colors[level])
 
         label = colored(label, 'cyan')
-        message = colored(syslog_entry['message'], 'white')
+        message = colored(message, 'white')
 
     line_format = '{timestamp} {process_name}{{{image_name}}}[{pid}] <{level}>: {message}'
 
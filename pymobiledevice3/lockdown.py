@@ -55,6 +55,7 @@ class LockdownClient(object):
         self.paired = False
         self.SessionID = None
         self.service = ServiceConnection.create(udid, self.SERVICE_PORT)
+        self.service.prefer_binary = False
         self.host_id = self.generate_host_id()
         self.system_buid = None
         self.label = client_name
@@ -80,6 +81,7 @@ class LockdownClient(object):
             if not self.validate_pairing():
                 raise FatalPairingError()
             self.service = ServiceConnection.create(udid, self.SERVICE_PORT)
+            self.service.prefer_binary = False
 
     def query_type(self):
         self.service.send_plist({'Request': 'QueryType'})
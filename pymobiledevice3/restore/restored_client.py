@@ -16,6 +16,7 @@ class RestoredClient(object):
         self.logger = logging.getLogger(__name__)
         udid = self._get_or_verify_udid(udid)
         self.service = ServiceConnection.create(udid, self.SERVICE_PORT)
+        self.service.prefer_binary = False
         self.label = client_name
         self.query_type = self.service.send_recv_plist({'Request': 'QueryType'})
         self.version = self.query_type.get('RestoreProtocolVersion')
@@ -1,14 +1,20 @@
+import base64
+import datetime
 import logging
+import os
 import plistlib
+import re
+import socket
 import ssl
 import struct
-from re import sub
+import time
+import typing
+from xml.parsers.expat import ExpatError
 
-import IPython
-from pygments import highlight, lexers, formatters
+from lxml import etree
 
 from pymobiledevice3 import usbmux
-from pymobiledevice3.exceptions import ConnectionFailedError, PyMobileDevice3Exception
+from pymobiledevice3.exceptions import ConnectionFailedError, NoDeviceConnectedError, PyMobileDevice3Exception
 
 SHELL_USAGE = """
 # This shell allows you to communicate directly with every service layer behind the lockdownd daemon.
@@ -26,27 +32,159 @@ client.send(b"hello")
 print(client.recvall(20))
 """
 
+RECV_INTO_CHUNK_SIZE = 256 * 1024
+SSL_CIPHERS = 'AES256-GCM-SHA384:AES128-GCM-SHA256:AES256-SHA'
+
+# seconds
+DEVICE_LOOKUP_TIMEOUT = 60
+DEVICE_LOOKUP_INITIAL_DELAY = 0.05
+DEVICE_LOOKUP_MAX_DELAY = 1
+
+_SHELL_BANNER = None
+
+
+def _get_shell_banner() -> str:
+    global _SHELL_BANNER
+    if _SHELL_BANNER is None:
+        from pygments import highlight, lexers, formatters
+        _SHELL_BANNER = highlight(SHELL_USAGE, lexers.PythonLexer(),
+                                  formatters.TerminalTrueColorFormatter(style='native'))
+    return _SHELL_BANNER
+
+
+# HAX lockdown HardwarePlatform with null bytes
+_PLIST_SCRUB = re.compile(r'[^\w<>\/ \-_0-9\"\'\\=\.\?\!\+]+')
+_LXML_PARSER = etree.XMLParser(huge_tree=False, resolve_entities=False)
+
+
+def _scrub_xml_plist(payload: bytes) -> bytes:
+    # scrub as str so non-ascii word characters (such as in DeviceName) are kept
+    return _PLIST_SCRUB.sub('', payload.decode('utf-8')).encode('utf-8')
+
+
+def _plist_text(element) -> str:
+    if len(element) == 0:
+        return element.text or ''
+    # skip any comments nested inside the element
+    return ''.join(element.itertext())
+
+
+def _plist_children(element):
+    return [child for child in element if isinstance(child.tag, str)]
+
+
+def _parse_plist_dict(element):
+    children = _plist_children(element)
+    if len(children) % 2 != 0:
+        raise plistlib.InvalidFileException()
+    result = {}
+    for key, value in zip(children[::2], children[1::2]):
+        if key.tag != 'key':
+            raise plistlib.InvalidFileException()
+        result[_plist_text(key)] = _parse_plist_element(value)
+    return result
+
+
+def _parse_plist_array(element):
+    return [_parse_plist_element(child) for child in _plist_children(element)]
+
+
+def _parse_plist_integer(element):
+    text = _plist_text(element).strip()
+    if text.startswith(('0x', '0X')):
+        return int(text, 16)
+    return int(text)
+
+
+def _parse_plist_date(element):
+    return datetime.datetime.strptime(_plist_text(element).strip(), '%Y-%m-%dT%H:%M:%SZ')
+
+
+_PLIST_ELEMENT_PARSERS = {
+    'dict': _parse_plist_dict,
+    'array': _parse_plist_array,
+    'string': _plist_text,
+    'integer': _parse_plist_integer,
+    'real': lambda element: float(_plist_text(element)),
+    'true': lambda element: True,
+    'false': lambda element: False,
+    'data': lambda element: base64.b64decode(_plist_text(element)),
+    'date': _parse_plist_date,
+}
+
+
+def _parse_plist_element(element):
+    parser = _PLIST_ELEMENT_PARSERS.get(element.tag)
+    if parser is None:
+        raise plistlib.InvalidFileException()
+    return parser(element)
+
+
+def _parse_xml_plist(payload: bytes):
+    """ parse an XML plist using lxml, falling back to plistlib on anything unusual """
+    try:
+        root = etree.fromstring(payload, _LXML_PARSER)
+        if root.tag == 'plist':
+            children = _plist_children(root)
+            if len(children) != 1:
+                raise plistlib.InvalidFileException()
+            root = children[0]
+        return _parse_plist_element(root)
+    except (etree.XMLSyntaxError, ValueError):
+        # let plistlib handle (and report) malformed plists exactly as it always did
+        return plistlib.loads(payload)
+
 
 class ServiceConnection(object):
+    # plist format used by send_plist() when none is given explicitly
+    prefer_binary = True
+
+    # u32 length prefixes used for message framing
+    _U32_BE = struct.Struct('>L')
+    _U32_LE = struct.Struct('<L')
+    _MAGIC_U32_BE = struct.Struct('>BL')
+    _MAGIC_U32_LE = struct.Struct('<BL')
+
+    _ssl_contexts = {}
+
     def __init__(self, socket):
         self.logger = logging.getLogger(__name__)
         self.socket = socket
 
     @staticmethod
-    def create(udid, port):
-        target_device = None
-        while target_device is None:
-            matching_devices = [device for device in usbmux.list_devices() if device.serial == udid]
-            if len(matching_devices) == 1:
-                target_device = matching_devices[0]
+    def create(udid, port, timeout: float = DEVICE_LOOKUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        delay = DEVICE_LOOKUP_INITIAL_DELAY
+        while True:
+            target_device = {device.serial: device for device in usbmux.list_devices()}.get(udid)
+            if target_device is not None:
                 break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise NoDeviceConnectedError(f'Device {udid} was not found within {timeout} seconds')
+            # wait for the device to be plugged in (or re-enumerated) without busy looping
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, DEVICE_LOOKUP_MAX_DELAY)
 
         try:
             socket = target_device.connect(port)
         except usbmux.MuxException:
             raise ConnectionFailedError(f'Connection to device port {port} failed')
 
-        return ServiceConnection(socket)
+        service_connection = ServiceConnection(socket)
+        service_connection._set_low_latency()
+        return service_connection
+
+    def _set_low_latency(self):
+        """ don't let Nagle's algorithm hold back the small request/response messages """
+        if self.socket.family not in (socket.AF_INET, socket.AF_INET6):
+            # usbmuxd is reached over a unix socket on everything but Windows
+            return
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @classmethod
+    def _u32(cls, endianity: str) -> struct.Struct:
+        return cls._U32_BE if endianity == '>' else cls._U32_LE
 
     def setblocking(self, blocking: bool):
         self.socket.setblocking(blocking)
@@ -61,34 +199,98 @@ class ServiceConnection(object):
     def sendall(self, data):
         self.socket.sendall(data)
 
-    def send_recv_plist(self, data, endianity='>', fmt=plistlib.FMT_XML):
+    def send_recv_plist(self, data, endianity='>', fmt=None):
         self.send_plist(data, endianity=endianity, fmt=fmt)
         return self.recv_plist(endianity=endianity)
 
     def recvall(self, size):
-        data = b''
-        while len(data) < size:
-            chunk = self.recv(size - len(data))
-            if chunk is None or len(chunk) == 0:
+        buf = bytearray(size)
+        self.recvall_into(memoryview(buf))
+        return bytes(buf)
+
+    def recvall_into(self, buf: memoryview):
+        """ fill the given writable buffer entirely with received data """
+        offset = 0
+        size = len(buf)
+        while offset < size:
+            received = self.socket.recv_into(buf[offset:], size - offset)
+            if not received:
                 raise ConnectionAbortedError()
-            data += chunk
-        return data
+            offset += received
 
     def recv_prefixed(self, endianity='>'):
         """ receive a data block prefixed with a u32 length field """
         size = self.recvall(4)
         if not size or len(size) != 4:
             return
-        size = struct.unpack(endianity + 'L', size)[0]
+        size, = self._u32(endianity).unpack(size)
         return self.recvall(size)
 
+    def recv_magic_prefixed(self, expected_magic: int, endianity='>'):
+        """ receive a data block prefixed with a u8 magic and a u32 length field """
+        return self.recvall(self._recv_magic_header(expected_magic, endianity))
+
+    def recv_magic_prefixed_into(self, out: typing.IO, expected_magic: int, endianity='>', allow_eof=False):
+        """
+        Same as recv_magic_prefixed(), only writing the data block into out without buffering it whole.
+
+        :param allow_eof: return None instead of raising if the connection was closed before a new block started
+        :return: size of the received data block
+        """
+        size = self._recv_magic_header(expected_magic, endianity, allow_eof=allow_eof)
+        if size is None:
+            return None
+        self._recv_into_file(out, size)
+        return size
+
+    def _recv_magic_header(self, expected_magic: int, endianity: str, allow_eof=False) -> typing.Optional[int]:
+        header = self._MAGIC_U32_BE if endianity == '>' else self._MAGIC_U32_LE
+        buf = bytearray(header.size)
+        view = memoryview(buf)
+        received = self.socket.recv_into(view, header.size)
+        if not received:
+            if allow_eof:
+                return None
+            raise ConnectionAbortedError()
+        # a header cut short is an error even when a clean EOF is allowed
+        self.recvall_into(view[received:])
+        magic, size = header.unpack(buf)
+        if magic != expected_magic:
+            raise PyMobileDevice3Exception(f'invalid magic: {magic} (expected {expected_magic})')
+        return size
+
+    def _recv_into_file(self, out: typing.IO, size: int):
+        view = memoryview(bytearray(min(size, RECV_INTO_CHUNK_SIZE)))
+        remaining = size
+        while remaining > 0:
+            received = self.socket.recv_into(view, min(remaining, len(view)))
+            if not received:
+                raise ConnectionAbortedError()
+            out.write(view[:received])
+            remaining -= received
+
     def send_prefixed(self, data):
         """ send a data block prefixed with a u32 length field """
         if isinstance(data, str):
             data = data.encode()
-        hdr = struct.pack('>L', len(data))
-        msg = b''.join([hdr, data])
-        return self.sendall(msg)
+        return self._send_with_length(self._U32_BE, data)
+
+    def _send_with_length(self, length_struct: struct.Struct, data: bytes):
+        """ send data prefixed with its length, without first copying both into a single message buffer """
+        if isinstance(self.socket, ssl.SSLSocket) or not hasattr(self.socket, 'sendmsg'):
+            # SSLSocket doesn't support sendmsg() (and neither does Windows)
+            message = bytearray(length_struct.size + len(data))
+            length_struct.pack_into(message, 0, len(data))
+            message[length_struct.size:] = data
+            return self.sendall(message)
+
+        buffers = [memoryview(length_struct.pack(len(data))), memoryview(data)]
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if buffers:
+                buffers[0] = buffers[0][sent:]
 
     def recv_plist(self, endianity='>'):
         payload = self.recv_prefixed(endianity=endianity)
@@ -99,28 +301,50 @@ class ServiceConnection(object):
         if payload.startswith(bplist_header):
             return plistlib.loads(payload)
         elif payload.startswith(xml_header):
-            # HAX lockdown HardwarePlatform with null bytes
-            payload = sub(r'[^\w<>\/ \-_0-9\"\'\\=\.\?\!\+]+', '', payload.decode('utf-8')).encode('utf-8')
-            return plistlib.loads(payload)
+            if b'\x00' in payload:
+                # HAX lockdown HardwarePlatform with null bytes, dropping them is usually enough
+                payload = payload.replace(b'\x00', b'')
+            try:
+                return _parse_xml_plist(payload)
+            except (ExpatError, plistlib.InvalidFileException):
+                return _parse_xml_plist(_scrub_xml_plist(payload))
         else:
             raise PyMobileDevice3Exception(f'recv_plist invalid data: {payload[:100].hex()}')
 
-    def send_plist(self, d, endianity='>', fmt=plistlib.FMT_XML):
+    def send_plist(self, d, endianity='>', fmt=None):
+        if fmt is None:
+            fmt = plistlib.FMT_BINARY if self.prefer_binary else plistlib.FMT_XML
         payload = plistlib.dumps(d, fmt=fmt)
-        message = struct.pack(endianity + 'L', len(payload))
-        return self.sendall(message + payload)
+        return self._send_with_length(self._u32(endianity), payload)
 
     def ssl_start(self, keyfile, certfile):
+        self.socket = self._get_ssl_context(keyfile, certfile).wrap_socket(self.socket)
+
+    @classmethod
+    def _get_ssl_context(cls, keyfile, certfile) -> ssl.SSLContext:
+        """ get an SSLContext shared by every connection using the same (unmodified) key and certificate files """
+        key = (keyfile, certfile)
+        mtimes = (os.stat(keyfile).st_mtime_ns, os.stat(certfile).st_mtime_ns)
+        cached = cls._ssl_contexts.get(key)
+        if cached is not None and cached[0] == mtimes:
+            return cached[1]
+
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        context.set_ciphers('AES256-SHA')
+        # prefer the GCM suites which OpenSSL can accelerate, keeping AES256-SHA for older devices
+        context.set_ciphers(SSL_CIPHERS)
         context.check_hostname = False
         context.verify_mode = ssl.CERT_NONE
         context.load_cert_chain(certfile, keyfile)
-        self.socket = context.wrap_socket(self.socket)
+        # replace any context created for a previous version of these files
+        cls._ssl_contexts[key] = (mtimes, context)
+        return context
 
     def shell(self):
+        # imported here since it is heavy and only needed for the interactive shell
+        import IPython
+
         IPython.embed(
-            header=highlight(SHELL_USAGE, lexers.PythonLexer(), formatters.TerminalTrueColorFormatter(style='native')),
+            header=_get_shell_banner(),
             user_ns={
                 'client': self,
             })
@@ -0,0 +1,113 @@
+"""
+numba compiled parsing of os_trace syslog frames.
+
+This module is optional and requires numba (and numpy) to be installed. Its layout must be kept in sync with
+`SYSLOG_FRAME_HEADER` and `SYSLOG_HEADER` in `os_trace.py`.
+"""
+import numba
+import numpy as np
+
+SYSLOG_MAGIC = 0x02
+SYSLOG_FRAME_HEADER_SIZE = 5
+SYSLOG_HEADER_SIZE = 129
+
+# columns of each row returned by parse_frames()
+FIELDS = ('pid', 'seconds', 'microseconds', 'level', 'filename_offset', 'filename_length', 'image_name_offset',
+          'image_name_length', 'message_offset', 'message_length', 'subsystem_offset', 'subsystem_length',
+          'category_offset', 'category_length')
+FIELD_COUNT = len(FIELDS)
+
+# returned instead of the consumed byte count when a frame doesn't start with SYSLOG_MAGIC
+INVALID_MAGIC = -1
+# returned instead of the consumed byte count when a record's fields don't fit inside its frame
+INVALID_RECORD = -2
+
+
+@numba.njit(cache=True)
+def _u16(buf, offset):
+    return np.int64(buf[offset]) | (np.int64(buf[offset + 1]) << 8)
+
+
+@numba.njit(cache=True)
+def _u32(buf, offset):
+    return _u16(buf, offset) | (_u16(buf, offset + 2) << 16)
+
+
+@numba.njit(cache=True)
+def _parse_record(buf, start, end, row):
+    """ fill row with the fields of the record at buf[start:end], returning False if it is malformed """
+    if end - start < SYSLOG_HEADER_SIZE:
+        return False
+    row[0] = _u32(buf, start + 9)
+    row[1] = _u32(buf, start + 55)
+    row[2] = _u32(buf, start + 63)
+    row[3] = buf[start + 68]
+    image_name_size = _u16(buf, start + 107)
+    message_size = _u16(buf, start + 109)
+    subsystem_size = _u32(buf, start + 117)
+    category_size = _u32(buf, start + 121)
+
+    offset = start + SYSLOG_HEADER_SIZE
+    filename_end = offset
+    while filename_end < end and buf[filename_end] != 0:
+        filename_end += 1
+    if filename_end == end:
+        return False
+    row[4] = offset
+    row[5] = filename_end - offset
+    offset = filename_end + 1
+
+    if offset + image_name_size + message_size > end:
+        return False
+
+    # the variable-length strings are null terminated, which isn't included in their reported lengths
+    row[6] = offset
+    row[7] = max(image_name_size - 1, 0)
+    offset += image_name_size
+    row[8] = offset
+    row[9] = max(message_size - 1, 0)
+    offset += message_size
+
+    if offset + subsystem_size + category_size <= end:
+        row[10] = offset
+        row[11] = max(subsystem_size - 1, 0)
+        offset += subsystem_size
+        row[12] = offset
+        row[13] = max(category_size - 1, 0)
+    else:
+        row[10] = -1
+        row[11] = 0
+        row[12] = -1
+        row[13] = 0
+    return True
+
+
+@numba.njit(cache=True)
+def parse_frames(buf):
+    """
+    Parse every complete framed syslog record in buf (a uint8 array).
+
+    :return: a (records, len(FIELDS)) int64 array and the number of bytes the records occupied (or INVALID_MAGIC /
+             INVALID_RECORD)
+    """
+    size = buf.shape[0]
+    rows = np.empty((size // (SYSLOG_FRAME_HEADER_SIZE + SYSLOG_HEADER_SIZE) + 1, FIELD_COUNT), dtype=np.int64)
+    count = 0
+    offset = 0
+    while size - offset >= SYSLOG_FRAME_HEADER_SIZE:
+        if buf[offset] != SYSLOG_MAGIC:
+            return rows[:count], INVALID_MAGIC
+        start = offset + SYSLOG_FRAME_HEADER_SIZE
+        end = start + _u32(buf, offset + 1)
+        if end > size:
+            break
+        if not _parse_record(buf, start, end, rows[count]):
+            return rows[:count], INVALID_RECORD
+        count += 1
+        offset = end
+    return rows[:count], offset
+
+
+def parse_buffer(buf: bytearray):
+    """ parse_frames() over a bytes-like object """
+    return parse_frames(np.frombuffer(buf, dtype=np.uint8))
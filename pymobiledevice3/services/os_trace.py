@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 import logging
+import os
 import plistlib
 import struct
-import tempfile
+import threading
 import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 from tarfile import TarFile
 
-from construct import Struct, Bytes, Int32ul, Optional, Enum, Byte, Adapter, Int16ul, this, Computed, \
-    RepeatUntil
 from pymobiledevice3.exceptions import PyMobileDevice3Exception
 from pymobiledevice3.lockdown import LockdownClient
 from pymobiledevice3.utils import try_decode
@@ -16,49 +17,140 @@ from pymobiledevice3.utils import try_decode
 CHUNK_SIZE = 4096
 TIME_FORMAT = '%H:%M:%S'
 SYSLOG_LINE_SPLITTER = '\n\x00'
+SYSLOG_READ_BUFFER_SIZE = 65536
+SYSLOG_MAGIC = 0x02
+
+_U32_LE = struct.Struct('<I').unpack
+
+# magic, length
+SYSLOG_FRAME_HEADER = struct.Struct('<BI')
+# unknown, length
+PID_LIST_HEADER = struct.Struct('>BI')
+
+# pid, seconds, microseconds, level, image_name_size, message_size, subsystem_size, category_size
+SYSLOG_HEADER = struct.Struct('<9xI42xI4xIxB38xHH6xII4x')
+SYSLOG_LEVELS = {0: 'Notice', 0x01: 'Info', 0x02: 'Debug', 0x10: 'Error', 0x11: 'Fault'}
+
+# numba compiled parser (None if unavailable), imported on first use since importing numba is slow
+_os_trace_fast = None
+_os_trace_fast_loaded = False
+
+
+@dataclass
+class SyslogEntry:
+    __slots__ = ('pid', 'timestamp', 'level', 'filename', 'image_name', 'message', 'subsystem', 'category')
+
+    pid: int
+    timestamp: datetime
+    level: typing.Union[str, int]
+    filename: str
+    image_name: str
+    message: str
+    subsystem: typing.Optional[str]
+    category: typing.Optional[str]
+
+
+def _parse_syslog_record(buf: bytes, start: int = 0, end: int = None) -> SyslogEntry:
+    """ parse the syslog record at buf[start:end] """
+    if end is None:
+        end = len(buf)
+    if end - start < SYSLOG_HEADER.size:
+        raise PyMobileDevice3Exception('invalid syslog record: too short')
+    pid, seconds, microseconds, level, image_name_size, message_size, subsystem_size, category_size = \
+        SYSLOG_HEADER.unpack_from(buf, start)
+    view = memoryview(buf)
+
+    offset = start + SYSLOG_HEADER.size
+    filename_end = buf.find(b'\x00', offset, end)
+    if filename_end == -1:
+        raise PyMobileDevice3Exception('invalid syslog record: unterminated filename')
+    filename = try_decode(bytes(view[offset:filename_end]))
+    offset = filename_end + 1
+
+    if offset + image_name_size + message_size > end:
+        raise PyMobileDevice3Exception('invalid syslog record: fields exceed record length')
+
+    image_name = try_decode(bytes(view[offset:offset + image_name_size - 1]))
+    offset += image_name_size
+    message = try_decode(bytes(view[offset:offset + message_size - 1]))
+    offset += message_size
+
+    subsystem = None
+    category = None
+    if offset + subsystem_size + category_size <= end:
+        subsystem = try_decode(bytes(view[offset:offset + subsystem_size - 1]))
+        offset += subsystem_size
+        category = try_decode(bytes(view[offset:offset + category_size - 1]))
+
+    return SyslogEntry(pid=pid, timestamp=datetime.fromtimestamp(seconds + (microseconds / 1000000)),
+                       level=SYSLOG_LEVELS.get(level, level), filename=filename, image_name=image_name,
+                       message=message, subsystem=subsystem, category=category)
+
+
+def _get_os_trace_fast():
+    global _os_trace_fast, _os_trace_fast_loaded
+    if not _os_trace_fast_loaded:
+        try:
+            from pymobiledevice3.services import _os_trace_fast as os_trace_fast
+        except ImportError:
+            # numba is an optional dependency, fallback to the pure python parser
+            os_trace_fast = None
+        _os_trace_fast = os_trace_fast
+        _os_trace_fast_loaded = True
+    return _os_trace_fast
+
+
+def _parse_many(buf: bytearray) -> typing.Tuple[typing.List[SyslogEntry], int]:
+    """
+    Parse every complete framed syslog record in buf.
 
-
-class TimestampAdapter(Adapter):
-    def _decode(self, obj, context, path):
-        return datetime.fromtimestamp(obj.seconds + (obj.microseconds / 1000000))
-
-    def _encode(self, obj, context, path):
-        return list(map(int, obj.split(".")))
-
-
-timestamp_t = Struct(
-    'seconds' / Int32ul,
-    Bytes(4),
-    'microseconds' / Int32ul
-)
-
-syslog_t = Struct(
-    Bytes(9),
-    'pid' / Int32ul,
-    Bytes(42),
-    'timestamp' / TimestampAdapter(timestamp_t),
-    Bytes(1),
-    'level' / Enum(Byte, Notice=0, Info=0x01, Debug=0x02, Error=0x10, Fault=0x11),
-    Bytes(38),
-    'image_name_size' / Int16ul,
-    'message_size' / Int16ul,
-    Bytes(6),
-    '_subsystem_size' / Int32ul,
-    '_category_size' / Int32ul,
-    Bytes(4),
-    '_filename' / RepeatUntil(lambda x, lst, ctx: lst[-1] == 0, Byte),
-    'filename' / Computed(lambda ctx: try_decode(bytearray(ctx._filename[:-1]))),
-    '_image_name' / Bytes(this.image_name_size),
-    'image_name' / Computed(lambda ctx: try_decode(ctx._image_name[:-1])),
-    '_message' / Bytes(this.message_size),
-    'message' / Computed(lambda ctx: try_decode(ctx._message[:-1])),
-    'label' / Optional(Struct(
-        '_subsystem' / Bytes(this._._subsystem_size),
-        'subsystem' / Computed(lambda ctx: try_decode(ctx._subsystem[:-1])),
-        '_category' / Bytes(this._._category_size),
-        'category' / Computed(lambda ctx: try_decode(ctx._category[:-1])),
-    )),
-)
+    :return: the parsed entries and the number of bytes they occupied
+    """
+    os_trace_fast = _get_os_trace_fast()
+    if os_trace_fast is not None:
+        return _parse_many_fast(os_trace_fast, buf)
+
+    entries = []
+    offset = 0
+    while len(buf) - offset >= SYSLOG_FRAME_HEADER.size:
+        magic, length = SYSLOG_FRAME_HEADER.unpack_from(buf, offset)
+        if magic != SYSLOG_MAGIC:
+            raise PyMobileDevice3Exception(f'invalid syslog magic: {magic}')
+        start = offset + SYSLOG_FRAME_HEADER.size
+        end = start + length
+        if end > len(buf):
+            break
+        entries.append(_parse_syslog_record(buf, start, end))
+        offset = end
+    return entries, offset
+
+
+def _parse_many_fast(os_trace_fast, buf: bytearray) -> typing.Tuple[typing.List[SyslogEntry], int]:
+    """ same as _parse_many(), only locating the fields using the numba compiled parser """
+    rows, consumed = os_trace_fast.parse_buffer(buf)
+    if consumed == os_trace_fast.INVALID_MAGIC:
+        raise PyMobileDevice3Exception('invalid syslog magic')
+    if consumed == os_trace_fast.INVALID_RECORD:
+        raise PyMobileDevice3Exception('invalid syslog record')
+
+    entries = []
+    with memoryview(buf) as view:
+        for pid, seconds, microseconds, level, filename_offset, filename_length, image_name_offset, \
+                image_name_length, message_offset, message_length, subsystem_offset, subsystem_length, \
+                category_offset, category_length in rows.tolist():
+            subsystem = None
+            category = None
+            if subsystem_offset != -1:
+                subsystem = try_decode(bytes(view[subsystem_offset:subsystem_offset + subsystem_length]))
+                category = try_decode(bytes(view[category_offset:category_offset + category_length]))
+            entries.append(SyslogEntry(
+                pid=pid, timestamp=datetime.fromtimestamp(seconds + (microseconds / 1000000)),
+                level=SYSLOG_LEVELS.get(level, level),
+                filename=try_decode(bytes(view[filename_offset:filename_offset + filename_length])),
+                image_name=try_decode(bytes(view[image_name_offset:image_name_offset + image_name_length])),
+                message=try_decode(bytes(view[message_offset:message_offset + message_length])),
+                subsystem=subsystem, category=category))
+    return entries, consumed
 
 
 class OsTraceService(object):
@@ -79,11 +171,9 @@ class OsTraceService(object):
     def get_pid_list(self):
         self.c.send_plist({'Request': 'PidList'})
 
-        # ignore first received unknown byte
-        self.c.recvall(1)
-
-        response = self.c.recv_prefixed()
-        return plistlib.loads(response)
+        # ignore first received unknown byte, and read it together with the length field
+        _, length = PID_LIST_HEADER.unpack(self.c.recvall(PID_LIST_HEADER.size))
+        return plistlib.loads(self.c.recvall(length))
 
     def create_archive(self, out: typing.IO, size_limit: int = None, age_limit: int = None, start_time: int = None):
         request = {'Request': 'CreateArchive'}
@@ -99,38 +189,64 @@ class OsTraceService(object):
 
         self.c.send_plist(request)
 
-        assert 1 == self.c.recvall(1)[0]
-
-        assert plistlib.loads(self.c.recv_prefixed()).get('Status') == 'RequestSuccessful', 'Invalid status'
+        response = plistlib.loads(self.c.recv_magic_prefixed(1))
+        assert response.get('Status') == 'RequestSuccessful', 'Invalid status'
 
-        while True:
-            try:
-                assert 3 == self.c.recvall(1)[0], 'invalid magic'
-            except ConnectionAbortedError:
-                break
-            out.write(self.c.recv_prefixed(endianity='<'))
+        # the device closes the connection once the whole archive was sent
+        while self.c.recv_magic_prefixed_into(out, 3, endianity='<', allow_eof=True) is not None:
+            pass
 
     def collect(self, out: str, size_limit: int = None, age_limit: int = None, start_time: int = None):
         """
         Collect the system logs into a .logarchive that can be viewed later with tools such as log or Console.
         """
-        with tempfile.NamedTemporaryFile() as tar:
-            self.create_archive(tar, size_limit=size_limit, age_limit=age_limit, start_time=start_time)
-            TarFile(tar.name).extractall(out)
+        read_fd, write_fd = os.pipe()
+        extraction_failed = threading.Event()
+
+        def produce():
+            try:
+                with os.fdopen(write_fd, 'wb') as writer:
+                    self.create_archive(writer, size_limit=size_limit, age_limit=age_limit, start_time=start_time)
+            except OSError:
+                # the reading end was closed due to an extraction error, which is the one worth reporting (writing
+                # into the closed pipe raises BrokenPipeError, or EINVAL on windows)
+                if not extraction_failed.is_set():
+                    raise
+
+        # extract the archive while it is still being received instead of staging it in a temporary file
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            producer = executor.submit(produce)
+            try:
+                with os.fdopen(read_fd, 'rb') as reader:
+                    try:
+                        with TarFile.open(fileobj=reader, mode='r|') as tar:
+                            tar.extractall(out)
+                        # drain the trailing padding so the producer isn't left writing into a closed pipe
+                        while reader.read(CHUNK_SIZE):
+                            pass
+                    except BaseException:
+                        extraction_failed.set()
+                        raise
+            finally:
+                producer.result()
 
     def syslog(self, pid=-1):
         self.c.send_plist({'Request': 'StartActivity', 'MessageFilter': 65535, 'Pid': pid, 'StreamFlags': 60})
 
-        length_length, = struct.unpack('<I', self.c.recvall(4))
-        length = int(self.c.recvall(length_length)[::-1].hex(), 16)
+        length_length, = _U32_LE(self.c.recvall(4))
+        length = int.from_bytes(self.c.recvall(length_length), 'little')
         response = plistlib.loads(self.c.recvall(length))
 
         if response.get('Status') != 'RequestSuccessful':
             raise PyMobileDevice3Exception(f'got invalid response: {response}')
 
+        # records are small and frequent, so parse every record received by a single read before yielding them
+        buf = bytearray()
         while True:
-            assert b'\x02' == self.c.recvall(1)
-            length, = struct.unpack('<I', self.c.recvall(4))
-            line = self.c.recvall(length)
-            entry = syslog_t.parse(line)
-            yield entry
+            chunk = self.c.recv(SYSLOG_READ_BUFFER_SIZE)
+            if not chunk:
+                raise ConnectionAbortedError()
+            buf += chunk
+            entries, consumed = _parse_many(buf)
+            del buf[:consumed]
+            yield from entries
@@ -3,6 +3,7 @@ import socket
 import select
 import threading
 
+from pymobiledevice3.exceptions import NoDeviceConnectedError
 from pymobiledevice3.lockdown import LockdownClient
 from pymobiledevice3.service_connection import ServiceConnection, ConnectionFailedError
 
@@ -10,6 +11,8 @@ from pymobiledevice3.service_connection import ServiceConnection, ConnectionFail
 class TcpForwarder:
     MAX_FORWARDED_CONNECTIONS = 200
     TIMEOUT = 1
+    # don't let a missing device block the other forwarded connections for long
+    DEVICE_LOOKUP_TIMEOUT = 1
 
     def __init__(self, lockdown: LockdownClient, src_port: int, dst_port: int, enable_ssl=False,
                  listening_event: threading.Event = None):
@@ -95,13 +98,14 @@ class TcpForwarder:
         local_connection.setblocking(False)
 
         try:
-            service_connection = ServiceConnection.create(self.lockdown.udid, self.dst_port)
+            service_connection = ServiceConnection.create(self.lockdown.udid, self.dst_port,
+                                                          timeout=self.DEVICE_LOOKUP_TIMEOUT)
 
             if self.enable_ssl:
                 service_connection.ssl_start(self.lockdown.ssl_file, self.lockdown.ssl_file)
 
             remote_connection = service_connection.socket
-        except ConnectionFailedError:
+        except (ConnectionFailedError, NoDeviceConnectedError):
             self.logger.error(f'failed to connect to port: {self.dst_port}')
             local_connection.close()
             return
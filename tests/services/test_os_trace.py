@@ -0,0 +1,195 @@
+import io
+import os
+import struct
+import tarfile
+from datetime import datetime
+
+import pytest
+from construct import Struct, Bytes, Int32ul, Optional, Enum, Byte, Adapter, Int16ul, this, Computed, RepeatUntil
+
+from pymobiledevice3.exceptions import PyMobileDevice3Exception
+from pymobiledevice3.services import os_trace
+from pymobiledevice3.utils import try_decode
+
+
+class TimestampAdapter(Adapter):
+    def _decode(self, obj, context, path):
+        return datetime.fromtimestamp(obj.seconds + (obj.microseconds / 1000000))
+
+    def _encode(self, obj, context, path):
+        return list(map(int, obj.split(".")))
+
+
+# the construct based parser os_trace used to use, kept as a reference implementation
+syslog_t = Struct(
+    Bytes(9),
+    'pid' / Int32ul,
+    Bytes(42),
+    'timestamp' / TimestampAdapter(Struct('seconds' / Int32ul, Bytes(4), 'microseconds' / Int32ul)),
+    Bytes(1),
+    'level' / Enum(Byte, Notice=0, Info=0x01, Debug=0x02, Error=0x10, Fault=0x11),
+    Bytes(38),
+    'image_name_size' / Int16ul,
+    'message_size' / Int16ul,
+    Bytes(6),
+    '_subsystem_size' / Int32ul,
+    '_category_size' / Int32ul,
+    Bytes(4),
+    '_filename' / RepeatUntil(lambda x, lst, ctx: lst[-1] == 0, Byte),
+    'filename' / Computed(lambda ctx: try_decode(bytearray(ctx._filename[:-1]))),
+    '_image_name' / Bytes(this.image_name_size),
+    'image_name' / Computed(lambda ctx: try_decode(ctx._image_name[:-1])),
+    '_message' / Bytes(this.message_size),
+    'message' / Computed(lambda ctx: try_decode(ctx._message[:-1])),
+    'label' / Optional(Struct(
+        '_subsystem' / Bytes(this._._subsystem_size),
+        'subsystem' / Computed(lambda ctx: try_decode(ctx._subsystem[:-1])),
+        '_category' / Bytes(this._._category_size),
+        'category' / Computed(lambda ctx: try_decode(ctx._category[:-1])),
+    )),
+)
+
+
+def build_record(pid=1, level=0, filename=b'/usr/libexec/foo', image_name=b'/usr/lib/libfoo.dylib\x00',
+                 message=b'hello\x00', subsystem=b'com.apple.foo\x00', category=b'default\x00', truncate=0):
+    header = bytes(9) + struct.pack('<I', pid) + bytes(42) + struct.pack('<I', 1600000000 + pid) + bytes(4) + \
+        struct.pack('<I', pid * 1000) + bytes(1) + bytes([level]) + bytes(38) + \
+        struct.pack('<HH', len(image_name), len(message)) + bytes(6) + \
+        struct.pack('<II', len(subsystem), len(category)) + bytes(4)
+    record = header + filename + b'\x00' + image_name + message + subsystem + category
+    return record[:len(record) - truncate]
+
+
+def build_frame(record, magic=os_trace.SYSLOG_MAGIC):
+    return os_trace.SYSLOG_FRAME_HEADER.pack(magic, len(record)) + record
+
+
+RECORDS = [
+    build_record(),
+    build_record(pid=2, level=0x11, message=b'\x00'),
+    build_record(pid=3, level=0x05),
+    build_record(pid=4, subsystem=b'', category=b''),
+    build_record(pid=5, truncate=1),
+    build_record(pid=6, subsystem=b'\xff\xfe\x00', category=b'\xff\x00'),
+    build_record(pid=7, image_name=b'', filename=b''),
+]
+
+
+@pytest.fixture(params=['python', 'numba'])
+def parser(request, monkeypatch):
+    """
+    Run the test against both the pure python parser and the numba compiled one.
+    """
+    if request.param == 'python':
+        monkeypatch.setattr(os_trace, '_get_os_trace_fast', lambda: None)
+    else:
+        pytest.importorskip('numba')
+    return request.param
+
+
+def assert_same_entry(entry, record):
+    expected = syslog_t.parse(record)
+    level = expected.level if isinstance(expected.level, str) else int(expected.level)
+    assert (entry.pid, entry.timestamp, entry.level, entry.filename, entry.image_name, entry.message) == \
+           (expected.pid, expected.timestamp, level, expected.filename, expected.image_name, expected.message)
+    if expected.label is None:
+        assert entry.subsystem is None and entry.category is None
+    else:
+        assert (entry.subsystem, entry.category) == (expected.label.subsystem, expected.label.category)
+
+
+@pytest.mark.parametrize('record', RECORDS)
+def test_parse_syslog_record(record):
+    """
+    Test a single record is parsed the same as the construct based parser.
+    """
+    assert_same_entry(os_trace._parse_syslog_record(record), record)
+
+
+def test_parse_many(parser):
+    """
+    Test parsing a batch of frames, leaving a partial trailing frame in the buffer.
+    """
+    frames = b''.join(build_frame(record) for record in RECORDS)
+    partial = build_frame(build_record())[:-3]
+    entries, consumed = os_trace._parse_many(bytearray(frames + partial))
+    assert consumed == len(frames)
+    assert len(entries) == len(RECORDS)
+    for entry, record in zip(entries, RECORDS):
+        assert_same_entry(entry, record)
+
+
+@pytest.mark.parametrize('frames', [
+    build_frame(build_record(), magic=3),
+    build_frame(build_record()) + build_frame(build_record(), magic=0),
+    build_frame(b'abc') * 200,
+    build_frame(build_record()[:os_trace.SYSLOG_HEADER.size] + b'no terminator') + build_frame(build_record()),
+    build_frame(build_record(message=b'\x00' * 5000)[:-4000]),
+])
+def test_parse_many_invalid(parser, frames):
+    """
+    Test invalid magics and malformed records are reported instead of being parsed.
+    """
+    with pytest.raises(PyMobileDevice3Exception):
+        os_trace._parse_many(bytearray(frames))
+
+
+def build_tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def create_service(create_archive):
+    """
+    Creates an OsTraceService whose archive is produced by create_archive(out), not requiring any device.
+    """
+    service = os_trace.OsTraceService.__new__(os_trace.OsTraceService)
+    service.create_archive = lambda out, **kwargs: create_archive(out)
+    return service
+
+
+def test_collect(tmp_path):
+    """
+    Test the archive is extracted while being received.
+    """
+    files = {'logdata.LiveData.tracev3': os.urandom(1024 * 1024), 'Info.plist': b'info'}
+    archive = build_tar(files)
+
+    def create_archive(out):
+        for i in range(0, len(archive), 4096):
+            out.write(archive[i:i + 4096])
+
+    create_service(create_archive).collect(str(tmp_path))
+    for name, data in files.items():
+        assert (tmp_path / name).read_bytes() == data
+
+
+def test_collect_receive_error(tmp_path):
+    """
+    Test errors receiving the archive are raised rather than the truncated archive's extraction error.
+    """
+    archive = build_tar({'logdata.LiveData.tracev3': os.urandom(1024 * 1024)})
+
+    def create_archive(out):
+        out.write(archive[:len(archive) // 2])
+        raise ConnectionAbortedError()
+
+    with pytest.raises(ConnectionAbortedError):
+        create_service(create_archive).collect(str(tmp_path))
+
+
+def test_collect_extraction_error(tmp_path):
+    """
+    Test extraction errors are raised rather than the error writing into the closed pipe.
+    """
+    def create_archive(out):
+        for _ in range(1024):
+            out.write(b'not a tar' * 1024)
+
+    with pytest.raises(tarfile.ReadError):
+        create_service(create_archive).collect(str(tmp_path))
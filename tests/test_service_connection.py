@@ -0,0 +1,166 @@
+import datetime
+import io
+import os
+import plistlib
+import socket
+import threading
+
+import pytest
+
+from pymobiledevice3.exceptions import PyMobileDevice3Exception
+from pymobiledevice3.service_connection import ServiceConnection, _parse_xml_plist
+
+XML_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>\n' \
+             b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" ' \
+             b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+
+
+@pytest.fixture
+def connection_pair():
+    """
+    Creates two connected ServiceConnection objects, not requiring any device.
+    """
+    first, second = socket.socketpair()
+    try:
+        yield ServiceConnection(first), ServiceConnection(second)
+    finally:
+        first.close()
+        second.close()
+
+
+@pytest.mark.parametrize('value', [
+    {'string': 'hello', 'empty_string': '', 'unicode': 'Jöhn iPhone', 'entities': '<a & b>'},
+    {'integer': 42, 'negative': -3, 'big': 2 ** 40, 'real': 2.5},
+    {'true': True, 'false': False},
+    {'data': b'\x00\x01\xff', 'empty_data': b''},
+    {'date': datetime.datetime(2021, 1, 2, 3, 4, 5)},
+    {'array': [1, 'two', [3.0], {}], 'empty_array': [], 'dict': {'nested': {'key': 'value'}}, 'empty_dict': {}},
+    ['top', 'level', 'array'],
+    'top level string',
+])
+def test_parse_xml_plist_round_trip(value):
+    """
+    Test parsing plists generated by plistlib yields the same result as plistlib.
+    """
+    payload = plistlib.dumps(value, fmt=plistlib.FMT_XML)
+    assert _parse_xml_plist(payload) == plistlib.loads(payload)
+
+
+@pytest.mark.parametrize('body, expected', [
+    (b'<integer>0x1F</integer>', 0x1f),
+    (b'<string>a&amp;b &#x41;</string>', 'a&b A'),
+    (b'<string/>', ''),
+    (b'<data></data>', b''),
+    (b'<dict><!-- comment --><key>a</key><!-- comment --><string>x<!-- comment -->y</string></dict>', {'a': 'xy'}),
+])
+def test_parse_xml_plist_edge_cases(body, expected):
+    """
+    Test parsing hand-written plists containing constructs plistlib never emits.
+    """
+    payload = XML_HEADER + b'<plist version="1.0">' + body + b'</plist>'
+    assert _parse_xml_plist(payload) == expected
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'<unknown/>',
+    b'<array><unknown/><string>value</string></array>',
+])
+def test_parse_xml_plist_unusual(body):
+    """
+    Test plists lxml parsing doesn't handle (empty or unknown elements) are parsed the same as plistlib does.
+    """
+    payload = XML_HEADER + b'<plist version="1.0">' + body + b'</plist>'
+    assert _parse_xml_plist(payload) == plistlib.loads(payload)
+
+
+@pytest.mark.parametrize('body', [
+    b'<dict><key>dangling</key></dict>',
+    b'<dict><string>not a key</string><string>value</string></dict>',
+])
+def test_parse_xml_plist_invalid(body):
+    """
+    Test malformed plists raise the same ValueError plistlib does.
+    """
+    payload = XML_HEADER + b'<plist version="1.0">' + body + b'</plist>'
+    with pytest.raises(ValueError):
+        _parse_xml_plist(payload)
+
+
+def test_recv_plist_null_bytes(connection_pair):
+    """
+    Test null bytes (lockdown HardwarePlatform) are dropped without scrubbing the other values.
+    """
+    sender, receiver = connection_pair
+    value = {'WiFiAddress': 'aa:bb', 'DeviceName': 'Jöhn (iPhone), & co\nline', 'HardwarePlatform': 't8101'}
+    payload = plistlib.dumps(value, fmt=plistlib.FMT_XML).replace(b't8101', b't8101\x00\x00')
+    sender.send_prefixed(payload)
+    assert receiver.recv_plist() == value
+
+
+def test_recv_plist_scrub_fallback(connection_pair):
+    """
+    Test plists which are still invalid after dropping null bytes are scrubbed as a last resort.
+    """
+    sender, receiver = connection_pair
+    payload = plistlib.dumps({'HardwarePlatform': 't8101'}, fmt=plistlib.FMT_XML)
+    sender.send_prefixed(payload.replace(b't8101', b't8101\x00\x01'))
+    assert receiver.recv_plist() == {'HardwarePlatform': 't8101'}
+
+
+@pytest.mark.parametrize('data', [b'', b'small', os.urandom(8 * 1024 * 1024)])
+def test_send_prefixed(connection_pair, data):
+    """
+    Test length prefixed sends, including large payloads which the kernel only accepts partially per sendmsg().
+    """
+    sender, receiver = connection_pair
+    # a socket with a timeout returns partial sends instead of blocking until everything was sent
+    sender.socket.settimeout(5)
+    send_thread = threading.Thread(target=sender.send_prefixed, args=(data,))
+    send_thread.start()
+    try:
+        assert receiver.recv_prefixed() == data
+    finally:
+        send_thread.join()
+
+
+def test_recv_magic_prefixed_into(connection_pair):
+    """
+    Test magic prefixed chunks are received until the sender closes the connection between chunks.
+    """
+    sender, receiver = connection_pair
+    sender.socket.sendall(b'\x03\x05\x00\x00\x00hello\x03\x00\x00\x00\x00')
+    sender.socket.close()
+    out = io.BytesIO()
+    assert receiver.recv_magic_prefixed_into(out, 3, endianity='<', allow_eof=True) == 5
+    assert receiver.recv_magic_prefixed_into(out, 3, endianity='<', allow_eof=True) == 0
+    assert receiver.recv_magic_prefixed_into(out, 3, endianity='<', allow_eof=True) is None
+    assert out.getvalue() == b'hello'
+
+
+@pytest.mark.parametrize('data, allow_eof', [
+    (b'', False),
+    (b'\x03\x0a\x00', False),
+    (b'\x03\x0a\x00', True),
+    (b'\x03\x0a\x00\x00\x00abcd', False),
+    (b'\x03\x0a\x00\x00\x00abcd', True),
+])
+def test_recv_magic_prefixed_into_truncated(connection_pair, data, allow_eof):
+    """
+    Test a connection closed in the middle of a chunk is reported, even when a clean EOF is allowed.
+    """
+    sender, receiver = connection_pair
+    sender.socket.sendall(data)
+    sender.socket.close()
+    with pytest.raises(ConnectionAbortedError):
+        receiver.recv_magic_prefixed_into(io.BytesIO(), 3, endianity='<', allow_eof=allow_eof)
+
+
+def test_recv_magic_prefixed_into_invalid_magic(connection_pair):
+    """
+    Test chunks not starting with the expected magic are rejected.
+    """
+    sender, receiver = connection_pair
+    sender.socket.sendall(b'\x01\x05\x00\x00\x00hello')
+    with pytest.raises(PyMobileDevice3Exception):
+        receiver.recv_magic_prefixed_into(io.BytesIO(), 3, endianity='<', allow_eof=True)